@@ -1,5 +1,11 @@
+import sys
 from .mwmfile import MWMFile, OsmIdCode
 from .mwm import MWM
-from .osm2ft import Osm2Ft
+from .osm2ft import Osm2Ft, Osm2FtTable
+from .stats import ReadStats
+from .cache import LRUCache
+from .registry import MWMRegistry
+if sys.version_info >= (3, 6):
+    from .aio import AsyncMWM
 
 __version__ = '0.10.1'
@@ -0,0 +1,76 @@
+# Asyncio Facade
+import asyncio
+import itertools
+from .mwm import MWM
+
+
+class AsyncMWM(object):
+    """Asyncio facade for an MWM file.
+
+    Reading and decoding run in an executor (the loop default if none is given).
+    The file is opened once: every worker thread reads it with its own cursor,
+    so concurrent requests never share a file position. Create it with
+    ``await AsyncMWM.open(path)`` to open the file in the executor too."""
+
+    def __init__(self, mwm, executor=None):
+        self.mwm = mwm
+        self.executor = executor
+
+    @staticmethod
+    def _open_mwm(path, types, cache_size):
+        f = open(path, 'rb')
+        try:
+            mwm = MWM(f, cache_size=cache_size)
+            if types:
+                mwm.read_types(types)
+        except Exception:
+            f.close()
+            raise
+        return mwm
+
+    @classmethod
+    async def open(cls, path, executor=None, types=None, cache_size=0):
+        """Opens an mwm file in the executor, returns an AsyncMWM."""
+        loop = asyncio.get_event_loop()
+        mwm = await loop.run_in_executor(executor, cls._open_mwm, path, types, cache_size)
+        return cls(mwm, executor)
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def read_version(self):
+        return await self._run(self.mwm.read_version)
+
+    async def read_header(self):
+        return await self._run(self.mwm.read_header)
+
+    async def get_feature(self, fid, metadata=False):
+        """Reads a single feature by its id, returns None if there is no such feature."""
+        return await self._run(self.mwm.get_feature, fid, metadata)
+
+    async def get_metadata(self, fid):
+        return await self._run(self.mwm.get_metadata, fid)
+
+    async def get_name(self, fid):
+        return await self._run(self.mwm.get_name, fid)
+
+    async def iter_features(self, metadata=False, bbox=None, batch=256):
+        """Iterates over features, decoding them in the executor by batches.
+        With bbox, yields only point features inside it."""
+        features = self.mwm.cursor().iter_features(metadata, bbox)
+        while True:
+            chunk = await self._run(lambda: list(itertools.islice(features, batch)))
+            if not chunk:
+                break
+            for feature in chunk:
+                yield feature
+
+    def close(self):
+        self.mwm.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
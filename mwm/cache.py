@@ -0,0 +1,73 @@
+# Decoded Data Cache
+import sys
+import threading
+from collections import OrderedDict
+
+
+def estimate_size(obj):
+    """Approximate memory taken by an object with its nested dicts, lists and tuples."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(estimate_size(k) + estimate_size(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(estimate_size(x) for x in obj)
+    return size
+
+
+class LRUCache(object):
+    """Thread-safe LRU cache bounded by an estimated size of values in bytes.
+
+    Keys are tuples starting with an owner that identifies a file and its
+    version, so one cache can be shared between readers: clear(owner) drops
+    entries of one of them. Cached values are shared, do not modify them."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.items = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return default
+            self.items[key] = item
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.size -= self.items.popitem(last=False)[1][1]
+
+    def clear(self, owner=None):
+        """Drops all entries, or only those of the given owner."""
+        with self._lock:
+            if owner is None:
+                self.items.clear()
+                self.size = 0
+                return
+            for key in [k for k in self.items if k[0] == owner]:
+                self.size -= self.items.pop(key)[1]
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __repr__(self):
+        return 'LRUCache with {} items, {} of {} bytes, {} hits, {} misses'.format(
+            len(self.items), self.size, self.max_bytes, self.hits, self.misses)
@@ -0,0 +1,243 @@
+# Release-to-release MWM Diff
+import hashlib
+import json
+import struct
+from multiprocessing import Pool, Queue
+from .mwm import MWM
+from .osm2ft import Osm2FtTable
+from .mwmfile import OsmIdCode
+
+FINGERPRINT_FIELDS = ('types', 'name', 'header', 'metadata', 'geometry')
+
+
+def hash_bytes(data):
+    """Returns a 64-bit hash of a byte string, stable between processes."""
+    return struct.unpack('<Q', hashlib.md5(data).digest()[:8])[0]
+
+
+def digest(value):
+    """Returns a 64-bit hash of a JSON-serializable value."""
+    return hash_bytes(json.dumps(value, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+
+
+def fingerprint(feature):
+    """Returns a tuple of hashes for each of FINGERPRINT_FIELDS of a feature.
+    Geometry is hashed from 'rawGeometry' bytes when the feature has them,
+    since only points have decoded coordinates. For lines and areas with
+    outer geometry these are bytes referenced in geomN and trgN sections,
+    not offsets into them, which change between releases."""
+    header = feature['header']
+    rest = {k: v for k, v in header.items() if k != 'types' and k != 'name'}
+    if 'rawGeometry' in feature:
+        geometry = hash_bytes(feature['rawGeometry'])
+    else:
+        geometry = digest(feature['geometry'])
+    return (digest(header['types']), digest(header.get('name')), digest(rest),
+            digest(feature.get('metadata')), geometry)
+
+
+def format_osmid(code):
+    osmid = OsmIdCode.unpack(code)
+    return None if osmid is None else '{0}{1}'.format(osmid[0], osmid[1])
+
+
+def _open_mwm(path, types):
+    f = open(path, 'rb')
+    try:
+        mwm = MWM(f)
+        if types:
+            mwm.read_types(types)
+    except Exception:
+        f.close()
+        raise
+    return mwm
+
+
+def combined_fingerprint(fp):
+    """Returns one 64-bit hash of a fingerprint tuple."""
+    return hash_bytes(struct.pack('<{0}Q'.format(len(fp)), *fp))
+
+
+def _read_osm_ids(osm2ft_path, unique=True):
+    """Reads osm2ft, returns arrays of osm id codes and feature ids sorted
+    by code, then by feature id. A feature keeps its last osm id, and unless
+    unique is False, an osm id keeps only its last feature."""
+    import numpy as np
+    with open(osm2ft_path, 'rb') as f:
+        table = Osm2FtTable(f, ft2osm=True)
+        table.close()
+    fids, codes = table.keys, table.values
+    if len(fids):
+        last = np.append(fids[1:] != fids[:-1], True)
+        fids, codes = fids[last], codes[last]
+        order = np.lexsort((fids, codes))
+        fids, codes = fids[order], codes[order]
+        if unique:
+            last = np.append(codes[1:] != codes[:-1], True)
+            fids, codes = fids[last], codes[last]
+    return codes, fids.astype(np.uint32)
+
+
+def _read_fingerprints(mwm, fids):
+    """Returns an array of combined fingerprints indexed by feature id,
+    with 0 for features not in fids, and a bool array of features found."""
+    import numpy as np
+    size = int(fids.max()) + 1 if len(fids) else 0
+    wanted = np.zeros(size, dtype=bool)
+    wanted[fids] = True
+    wanted = bytearray(wanted.tobytes())
+    fps = np.zeros(size, dtype=np.uint64)
+    found = np.zeros(size, dtype=bool)
+    for feature in mwm.iter_features(raw_geometry=True):
+        fid = feature['id']
+        if fid >= size or not wanted[fid]:
+            continue
+        md = mwm.get_metadata(fid)
+        if md:
+            feature['metadata'] = md
+        fps[fid] = combined_fingerprint(fingerprint(feature))
+        found[fid] = True
+    return fps, found
+
+
+def _read_feature(mwm, fid):
+    """Reads a feature with metadata by id, returns it and its fingerprint."""
+    mwm.f.seek(mwm.read_feature_offsets()[fid])
+    feature = mwm.read_feature(fid, raw_geometry=True)
+    md = mwm.get_metadata(fid)
+    if md:
+        feature['metadata'] = md
+    fp = fingerprint(feature)
+    del feature['rawGeometry']
+    return feature, fp
+
+
+def diff_mwm(old_path, new_path, old_osm2ft=None, new_osm2ft=None, types=None):
+    """Compares features of two versions of an mwm, matching them by osm ids
+    from osm2ft files (by default next to the mwm files). Requires NumPy.
+
+    Yields dicts with 'change' ('added', 'removed' or 'changed'), 'osm',
+    'old_id', 'new_id' and 'feature' (the new one, or the old one for removed).
+    Changed records also have 'fields' and 'old_feature'.
+
+    For each file, memory holds NumPy arrays of osm id codes and feature ids
+    from osm2ft (12 bytes per record), a combined 64-bit fingerprint and
+    a found flag per feature id (9 bytes), the metadata index (8 bytes per
+    feature with metadata) and, once a feature is read by id, an array of
+    feature offsets (8 bytes per feature). Features are read again for output."""
+    import numpy as np
+    old_mwm = _open_mwm(old_path, types)
+    try:
+        new_mwm = _open_mwm(new_path, types)
+    except Exception:
+        old_mwm.close()
+        raise
+    try:
+        old_codes, old_fids = _read_osm_ids(old_osm2ft or old_path + '.osm2ft')
+        new_codes, new_fids = _read_osm_ids(new_osm2ft or new_path + '.osm2ft', unique=False)
+        old_fps, old_found = _read_fingerprints(old_mwm, old_fids)
+        new_fps, new_found = _read_fingerprints(new_mwm, new_fids)
+        # Keep only features present in dat sections
+        keep = old_found[old_fids]
+        old_codes, old_fids = old_codes[keep], old_fids[keep]
+        keep = new_found[new_fids]
+        new_codes, new_fids = new_codes[keep], new_fids[keep]
+
+        # Match new osm ids to old ones, both arrays are sorted by code.
+        # Of new features sharing an osm id, the first one is matched.
+        pos = np.searchsorted(old_codes, new_codes)
+        pos[pos >= len(old_codes)] = 0
+        if len(old_codes):
+            matched = old_codes[pos] == new_codes
+            matched[1:] &= new_codes[1:] != new_codes[:-1]
+            old_match_fids = old_fids[pos]
+        else:
+            matched = np.zeros(len(new_codes), dtype=bool)
+            old_match_fids = pos
+        removed = np.ones(len(old_codes), dtype=bool)
+        removed[pos[matched]] = False
+        changed = matched.copy()
+        changed[matched] = old_fps[old_match_fids[matched]] != new_fps[new_fids[matched]]
+        del old_fps, new_fps
+
+        # Added and changed features, in order of new feature ids
+        report = np.flatnonzero(~matched | changed)
+        for i in report[np.argsort(new_fids[report], kind='stable')]:
+            fid = int(new_fids[i])
+            record = {'osm': format_osmid(int(new_codes[i])), 'new_id': fid}
+            feature, fp = _read_feature(new_mwm, fid)
+            if matched[i]:
+                old_fid = int(old_match_fids[i])
+                old_feature, old_fp = _read_feature(old_mwm, old_fid)
+                record['change'] = 'changed'
+                record['old_id'] = old_fid
+                record['fields'] = [FINGERPRINT_FIELDS[k] for k in range(len(fp))
+                                    if fp[k] != old_fp[k]]
+                record['old_feature'] = old_feature
+            else:
+                record['change'] = 'added'
+                record['old_id'] = None
+            record['feature'] = feature
+            yield record
+
+        report = np.flatnonzero(removed)
+        for i in report[np.argsort(old_fids[report], kind='stable')]:
+            fid = int(old_fids[i])
+            yield {'change': 'removed', 'osm': format_osmid(int(old_codes[i])), 'old_id': fid,
+                   'new_id': None, 'feature': _read_feature(old_mwm, fid)[0]}
+    finally:
+        old_mwm.close()
+        new_mwm.close()
+
+
+# Queue for records in worker processes of diff_many()
+_queue = None
+
+
+def _init_worker(queue):
+    global _queue
+    _queue = queue
+
+
+def _diff_pair(task):
+    """Sends records for a pair to the queue in chunks, then None when done."""
+    old_path, new_path, types, chunk_size = task
+    chunk = []
+    try:
+        for record in diff_mwm(old_path, new_path, types=types):
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                _queue.put((old_path, new_path, chunk))
+                chunk = []
+    except EnvironmentError as e:
+        chunk.append({'change': 'error', 'error': str(e)})
+    finally:
+        if chunk:
+            _queue.put((old_path, new_path, chunk))
+        _queue.put((old_path, new_path, None))
+
+
+def diff_many(pairs, processes=None, types=None, chunk_size=1000, max_chunks=16):
+    """Compares pairs of (old path, new path) in a pool of processes.
+    Yields (old path, new path, record) while workers go on. Records come in
+    chunks through a queue of at most max_chunks, so memory stays bounded when
+    the consumer is slower. A pair that cannot be read, for example for
+    a missing osm2ft file, yields a record with 'change' set to 'error'
+    and an 'error' message."""
+    tasks = [(old_path, new_path, types, chunk_size) for old_path, new_path in pairs]
+    queue = Queue(max_chunks)
+    pool = Pool(processes, _init_worker, (queue,))
+    try:
+        result = pool.map_async(_diff_pair, tasks, chunksize=1)
+        pending = len(tasks)
+        while pending:
+            old_path, new_path, chunk = queue.get()
+            if chunk is None:
+                pending -= 1
+                continue
+            for record in chunk:
+                yield old_path, new_path, record
+        # Raises exceptions other than I/O errors from workers
+        result.get()
+    finally:
+        pool.terminate()
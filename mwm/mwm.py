@@ -1,11 +1,19 @@
 # MWM Reader Module
 from .mwmfile import MWMFile
+from .cache import LRUCache
+from array import array
+from bisect import bisect_right
 from datetime import datetime
+import itertools
 import os
+import threading
 
 # Unprocessed sections: geomN, trgN, idx, sdx (search index),
 # addr (search address), offs (feature offsets - succinct)
 
+# Identities for cache owners of readers not backed by a file
+_reader_ids = itertools.count()
+
 # TODO:
 # - Predictive reading of LineStrings
 # - Find why polygon geometry is incorrect in iter_features()
@@ -24,13 +32,40 @@ class MWM(MWMFile):
     regiondata = ["languages", "driving", "timezone", "addr_fmt", "phone_fmt",
                   "postcode_fmt", "holidays", "housenames"]
 
-    def __init__(self, f):
-        MWMFile.__init__(self, f)
+    timed_decoders = MWMFile.timed_decoders + [
+        'read_version', 'read_header', 'read_region_info', 'read_metadata',
+        'read_crossmwm', 'iter_features', 'read_feature_offsets', 'get_feature',
+        'get_metadata', 'get_name']
+
+    def __init__(self, f, stats=False, cache_size=0):
+        MWMFile.__init__(self, f, stats)
+        self.feature_offsets = None
+        self.metadata_index = None
+        self.metadata_fmt = None
+        self._index_lock = threading.Lock()
+        self.cache = None
+        self.cache_owner = None
         self.read_tags()
-        self.read_header()
+        self.header = self.read_header()
         self.type_mapping = []
         self.read_types(os.path.join(
             os.getcwd(), os.path.dirname(__file__), 'types.txt'))
+        if cache_size:
+            self.set_cache(LRUCache(cache_size))
+
+    def set_cache(self, cache):
+        """Sets an LRUCache for features, metadata and names read by id.
+        Entries are keyed by the file (device and inode) and its version,
+        so a cache can be shared between readers of different files."""
+        self.cache = cache
+        if cache is not None:
+            try:
+                st = os.fstat(self.file.fileno())
+                identity = (st.st_dev, st.st_ino)
+            except (AttributeError, EnvironmentError, ValueError):
+                identity = ('reader', next(_reader_ids))
+            version = self.read_version() if self.has_tag('version') else {}
+            self.cache_owner = (identity, version.get('fmt'), version.get('date'))
 
     def read_types(self, filename):
         if not os.path.exists(filename):
@@ -40,6 +75,8 @@ class MWM(MWMFile):
             for line in ft:
                 if len(line.strip()) > 0:
                     self.type_mapping.append(line.strip().replace('|', '-'))
+        if self.cache is not None:
+            self.cache.clear(self.cache_owner)
 
     def read_version(self):
         """Reads 'version' section."""
@@ -101,56 +138,91 @@ class MWM(MWMFile):
                     fields[t] = [self.languages[ord(x)] for x in fields[t]]
         return fields
 
+    def read_metadata_index(self):
+        """Reads 'metaidx' section, returns two arrays sorted by feature id:
+        feature ids and offsets of their records in 'meta'."""
+        if self.metadata_index is None:
+            with self._index_lock:
+                if self.metadata_index is None:
+                    pairs = array('I')
+                    if self.has_tag('metaidx'):
+                        # Metadata format is different since v8
+                        self.metadata_fmt = self.read_version()['fmt']
+                        self.seek_tag('metaidx')
+                        data = self.f.read(self.tags['metaidx'][1] // 8 * 8)
+                        if hasattr(pairs, 'frombytes'):
+                            pairs.frombytes(data)
+                        else:
+                            pairs.fromstring(data)
+                    fids, offsets = pairs[0::2], pairs[1::2]
+                    if any(fids[i] > fids[i + 1] for i in range(len(fids) - 1)):
+                        # Stable, so the last of duplicate ids wins as in a dict
+                        order = sorted(range(len(fids)), key=fids.__getitem__)
+                        fids = array('I', (fids[i] for i in order))
+                        offsets = array('I', (offsets[i] for i in order))
+                    self.metadata_index = (fids, offsets)
+        return self.metadata_index
+
+    def read_metadata_record(self, fmt):
+        """Reads one metadata record at the current position, returns a dict."""
+        fields = {}
+        if fmt >= 8:
+            sz = self.read_varuint()
+            if sz:
+                for i in range(sz):
+                    t = self.read_varuint()
+                    t = self.metadata[t] if t < len(self.metadata) else str(t)
+                    fields[t] = self.read_string()
+                    if t == 'fuel':
+                        fields[t] = fields[t].split('\x01')
+        else:
+            while True:
+                t = self.read_uint(1)
+                is_last = t & 0x80 > 0
+                t = t & 0x7f
+                t = self.metadata[t] if t < len(self.metadata) else str(t)
+                l = self.read_uint(1)
+                fields[t] = self.f.read(l).decode('utf-8')
+                if is_last:
+                    break
+        return fields
+
     def read_metadata(self):
         """Reads 'meta' and 'metaidx' sections."""
         if not self.has_tag('metaidx'):
             return {}
-        # Metadata format is different since v8
-        fmt = self.read_version()['fmt']
         # First, read metaidx, to match featureId <-> metadata
-        self.seek_tag('metaidx')
-        ftid_meta = []
-        while self.inside_tag('metaidx'):
-            ftid = self.read_uint(4)
-            moffs = self.read_uint(4)
-            ftid_meta.append((moffs, ftid))
-        # Sort ftid_meta array
-        ftid_meta.sort(key=lambda x: x[0])
-        ftpos = 0
+        fids, offsets = self.read_metadata_index()
+        offs_ftid = dict(zip(offsets, fids))
+        fmt = self.metadata_fmt
         # Now read metadata
         self.seek_tag('meta')
         metadatar = {}
         while self.inside_tag('meta'):
             tag_pos = self.tag_offset('meta')
-            fields = {}
-            if fmt >= 8:
-                sz = self.read_varuint()
-                if sz:
-                    for i in range(sz):
-                        t = self.read_varuint()
-                        t = self.metadata[t] if t < len(self.metadata) else str(t)
-                        fields[t] = self.read_string()
-                        if t == 'fuel':
-                            fields[t] = fields[t].split('\x01')
-            else:
-                while True:
-                    t = self.read_uint(1)
-                    is_last = t & 0x80 > 0
-                    t = t & 0x7f
-                    t = self.metadata[t] if t < len(self.metadata) else str(t)
-                    l = self.read_uint(1)
-                    fields[t] = self.f.read(l).decode('utf-8')
-                    if is_last:
-                        break
-
-            if len(fields):
-                while ftpos < len(ftid_meta) and ftid_meta[ftpos][0] < tag_pos:
-                    ftpos += 1
-                if ftpos < len(ftid_meta):
-                    if ftid_meta[ftpos][0] == tag_pos:
-                        metadatar[ftid_meta[ftpos][1]] = fields
+            fields = self.read_metadata_record(fmt)
+            if len(fields) and tag_pos in offs_ftid:
+                metadatar[offs_ftid[tag_pos]] = fields
         return metadatar
 
+    def get_metadata(self, fid):
+        """Reads metadata for a single feature, returns None if it has none."""
+        if self.cache is not None:
+            key = (self.cache_owner, 'meta', fid)
+            md = self.cache.get(key, key)
+            if md is not key:
+                return md
+        fids, offsets = self.read_metadata_index()
+        i = bisect_right(fids, fid) - 1
+        if i < 0 or fids[i] != fid:
+            md = None
+        else:
+            self.f.seek(self.tags['meta'][0] + offsets[i])
+            md = self.read_metadata_record(self.metadata_fmt) or None
+        if self.cache is not None:
+            self.cache.put(key, md)
+        return md
+
     def read_crossmwm(self):
         """Reads 'chrysler' section (cross-mwm routing table)."""
         if not self.has_tag('chrysler'):
@@ -187,8 +259,71 @@ class MWM(MWMFile):
             neighbours.append(self.f.read(size).decode('utf-8'))
         return {'in': incoming, 'out': outgoing, 'matrix': matrix, 'neighbours': neighbours}
 
-    def iter_features(self, metadata=False):
-        """Reads 'dat' section."""
+    def read_feature_offsets(self):
+        """Scans 'dat' section, returns an array of feature offsets indexed by feature id."""
+        if self.feature_offsets is None:
+            with self._index_lock:
+                if self.feature_offsets is None:
+                    offsets = array('L')
+                    if self.has_tag('dat'):
+                        self.seek_tag('dat')
+                        f = self.f
+                        dat_end = self.tags['dat'][0] + self.tags['dat'][1]
+                        while f.tell() < dat_end:
+                            offsets.append(f.tell())
+                            feature_size = self.read_varuint()
+                            f.seek(feature_size, 1)
+                    self.feature_offsets = offsets
+        return self.feature_offsets
+
+    def get_feature(self, fid, metadata=False):
+        """Reads a single feature by its id, returns None if there is no such feature."""
+        if self.cache is not None:
+            key = (self.cache_owner, 'feature', fid, metadata)
+            feature = self.cache.get(key)
+            if feature is not None:
+                return feature
+        offsets = self.read_feature_offsets()
+        if fid < 0 or fid >= len(offsets):
+            return None
+        self.f.seek(offsets[fid])
+        feature = self.read_feature(fid)
+        if metadata:
+            md = self.get_metadata(fid)
+            if md:
+                feature['metadata'] = md
+        if self.cache is not None:
+            self.cache.put(key, feature)
+        return feature
+
+    def get_name(self, fid):
+        """Returns a dict of multilingual names for a feature, or None."""
+        if self.cache is not None:
+            key = (self.cache_owner, 'name', fid)
+            name = self.cache.get(key, key)
+            if name is not key:
+                return name
+        offsets = self.read_feature_offsets()
+        name = None
+        if 0 <= fid < len(offsets):
+            self.f.seek(offsets[fid])
+            name = self.read_feature(fid)['header'].get('name')
+        if self.cache is not None:
+            self.cache.put(key, name)
+        return name
+
+    @staticmethod
+    def point_in_bbox(feature, bbox):
+        """Tests a feature against (min_lon, min_lat, max_lon, max_lat).
+        Only points have decoded geometry, so other features never match."""
+        coords = feature['geometry'].get('coordinates')
+        if not coords or feature['geometry']['type'] != 'Point':
+            return False
+        return bbox[0] <= coords[0] <= bbox[2] and bbox[1] <= coords[1] <= bbox[3]
+
+    def iter_features(self, metadata=False, bbox=None, raw_geometry=False):
+        """Reads 'dat' section. With bbox, yields only point features inside it.
+        With raw_geometry, features have 'rawGeometry' bytes, see read_raw_geometry()."""
         if not self.has_tag('dat'):
             return
         # TODO: read 'offs'?
@@ -196,80 +331,130 @@ class MWM(MWMFile):
         if metadata:
             md = self.read_metadata()
         self.seek_tag('dat')
+        dat_end = self.tags['dat'][0] + self.tags['dat'][1]
+        f = self.f
         ftid = -1
-        while self.inside_tag('dat'):
+        while f.tell() < dat_end:
             ftid += 1
-            feature = {'id': ftid}
-            feature_size = self.read_varuint()
-            next_feature = self.f.tell() + feature_size
-            feature['size'] = feature_size
-
-            # Header
-            header = {}
-            header_bits = self.read_uint(1)
-            types_count = (header_bits & 0x07) + 1
-            has_name = header_bits & 0x08 > 0
-            has_layer = header_bits & 0x10 > 0
-            has_addinfo = header_bits & 0x80 > 0
-            geom_type = header_bits & 0x60
-            types = []
-            for i in range(types_count):
-                type_id = self.read_varuint()
-                if type_id < len(self.type_mapping):
-                    types.append(self.type_mapping[type_id])
-                else:
-                    types.append(str(type_id + 1))  # So the numbers match with mapcss-mapping.csv
-            header['types'] = types
-            if has_name:
-                header['name'] = self.read_multilang()
-            if has_layer:
-                header['layer'] = self.read_uint(1)
-            if has_addinfo:
-                if geom_type == MWM.GeomType.POINT:
-                    header['rank'] = self.read_uint(1)
-                elif geom_type == MWM.GeomType.LINE:
-                    header['ref'] = self.read_string()
-                elif geom_type == MWM.GeomType.AREA or geom_type == MWM.GeomType.POINT_EX:
-                    header['house'] = self.read_numeric_string()
-            feature['header'] = header
-
-            # Metadata
+            feature = self.read_feature(ftid, raw_geometry)
+            next_feature = f.tell()
+            if bbox is not None and not self.point_in_bbox(feature, bbox):
+                continue
             if ftid in md:
                 feature['metadata'] = md[ftid]
+            yield feature
+            # Resumed generator may run on another thread with another cursor
+            f = self.f
+            f.seek(next_feature)
 
-            # Geometry
-            geometry = {}
-            if geom_type == MWM.GeomType.POINT or geom_type == MWM.GeomType.POINT_EX:
-                geometry['type'] = 'Point'
-            elif geom_type == MWM.GeomType.LINE:
-                geometry['type'] = 'LineString'
-            elif geom_type == MWM.GeomType.AREA:
-                geometry['type'] = 'Polygon'
+    def read_raw_geometry(self, geom_type, end):
+        """Returns geometry bytes of a feature at the current position, which
+        is kept. Lines and areas with outer geometry store varuint offsets into
+        geomN and trgN sections, which shift between files, so instead of the
+        offsets this returns the header byte and the referenced data."""
+        f = self.f
+        pos = f.tell()
+        if geom_type != MWM.GeomType.LINE and geom_type != MWM.GeomType.AREA:
+            data = f.read(end - pos)
+        else:
+            header2 = f.read(1)
+            count = bytearray(header2)[0] & 0x0F
+            if count > 0:
+                # Inner geometry: simplification masks and points, or triangles
+                data = header2 + f.read(end - pos - 1)
+            else:
+                tag = 'geom' if geom_type == MWM.GeomType.LINE else 'trg'
+                mask = bytearray(header2)[0] >> 4
+                offsets = []
+                for i in range(4):
+                    if mask & (1 << i):
+                        offsets.append(('{0}{1}'.format(tag, i), self.read_varuint()))
+                parts = [header2]
+                for name, offset in offsets:
+                    if name not in self.tags:
+                        continue
+                    f.seek(self.tags[name][0] + offset)
+                    start = f.tell()
+                    size = self.read_varuint()
+                    size += f.tell() - start
+                    f.seek(start)
+                    parts.append(f.read(size))
+                data = b''.join(parts)
+        f.seek(pos)
+        return data
+
+    def read_feature(self, ftid, raw_geometry=False):
+        """Reads a feature at the current position and moves to the next one."""
+        feature = {'id': ftid}
+        feature_size = self.read_varuint()
+        f = self.f
+        next_feature = f.tell() + feature_size
+        feature['size'] = feature_size
+
+        # Header
+        header = {}
+        header_bits = self.read_uint(1)
+        types_count = (header_bits & 0x07) + 1
+        has_name = header_bits & 0x08 > 0
+        has_layer = header_bits & 0x10 > 0
+        has_addinfo = header_bits & 0x80 > 0
+        geom_type = header_bits & 0x60
+        types = []
+        for i in range(types_count):
+            type_id = self.read_varuint()
+            if type_id < len(self.type_mapping):
+                types.append(self.type_mapping[type_id])
+            else:
+                types.append(str(type_id + 1))  # So the numbers match with mapcss-mapping.csv
+        header['types'] = types
+        if has_name:
+            header['name'] = self.read_multilang()
+        if has_layer:
+            header['layer'] = self.read_uint(1)
+        if has_addinfo:
             if geom_type == MWM.GeomType.POINT:
-                geometry['coordinates'] = list(self.read_coord())
+                header['rank'] = self.read_uint(1)
+            elif geom_type == MWM.GeomType.LINE:
+                header['ref'] = self.read_string()
+            elif geom_type == MWM.GeomType.AREA or geom_type == MWM.GeomType.POINT_EX:
+                header['house'] = self.read_numeric_string()
+        feature['header'] = header
+        if raw_geometry:
+            feature['rawGeometry'] = self.read_raw_geometry(geom_type, next_feature)
 
-            # (flipping table emoticon)
-            feature['geometry'] = geometry
-            if False:
-                if geom_type != MWM.GeomType.POINT:
-                    polygon_count = self.read_varuint()
-                    polygons = []
-                    for i in range(polygon_count):
-                        count = self.read_varuint()
-                        buf = self.f.read(count)
-                        # TODO: decode
-                    geometry['coordinates'] = polygons
-                    feature['coastCell'] = self.read_varint()
+        # Geometry
+        geometry = {}
+        if geom_type == MWM.GeomType.POINT or geom_type == MWM.GeomType.POINT_EX:
+            geometry['type'] = 'Point'
+        elif geom_type == MWM.GeomType.LINE:
+            geometry['type'] = 'LineString'
+        elif geom_type == MWM.GeomType.AREA:
+            geometry['type'] = 'Polygon'
+        if geom_type == MWM.GeomType.POINT:
+            geometry['coordinates'] = list(self.read_coord())
 
-                # OSM IDs
-                count = self.read_varuint()
-                osmids = []
-                for i in range(count):
-                    osmid = self.read_osmid()
-                    osmids.append('{0}{1}'.format(osmid[0], osmid[1]))
-                feature['osmIds'] = osmids
+        # (flipping table emoticon)
+        feature['geometry'] = geometry
+        if False:
+            if geom_type != MWM.GeomType.POINT:
+                polygon_count = self.read_varuint()
+                polygons = []
+                for i in range(polygon_count):
+                    count = self.read_varuint()
+                    buf = f.read(count)
+                    # TODO: decode
+                geometry['coordinates'] = polygons
+                feature['coastCell'] = self.read_varint()
 
-            if self.f.tell() > next_feature:
-                raise Exception('Feature parsing error, read too much')
-            yield feature
-            self.f.seek(next_feature)
+            # OSM IDs
+            count = self.read_varuint()
+            osmids = []
+            for i in range(count):
+                osmid = self.read_osmid()
+                osmids.append('{0}{1}'.format(osmid[0], osmid[1]))
+            feature['osmIds'] = osmids
+
+        if f.tell() > next_feature:
+            raise Exception('Feature parsing error, read too much')
+        f.seek(next_feature)
+        return feature
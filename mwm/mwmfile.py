@@ -1,6 +1,14 @@
 # MWM Reader Module
+import copy
+import mmap
 import struct
+import sys
 import math
+import threading
+from .stats import ReadStats, CountingFile
+
+_PY2 = sys.version_info[0] < 3
+_UINT_STRUCTS = {n: struct.Struct(fmt) for n, fmt in ((1, 'B'), (2, 'H'), (4, 'I'), (8, 'Q'))}
 
 
 class OsmIdCode(object):
@@ -61,6 +69,78 @@ class OsmIdCode(object):
             result = -1 - (result ^ (2**64 - 1))
         return result
 
+    @staticmethod
+    def _as_uint64(nums):
+        import numpy as np
+        if isinstance(nums, np.ndarray) and nums.dtype.kind in 'iu':
+            return nums.astype(np.int64 if nums.dtype.kind == 'i' else np.uint64).view(np.uint64)
+        try:
+            return np.asarray(nums, dtype=np.uint64)
+        except (OverflowError, TypeError, ValueError):
+            # Python ints may mix negative int64 and large uint64 values
+            return np.array([int(n) & (2**64 - 1) for n in nums], dtype=np.uint64)
+
+    @staticmethod
+    def unpack_many(nums):
+        """Unpacks an array of uint64 or int64 codes with NumPy, returns a tuple
+        of arrays: types ('n', 'w', 'r', or '' for invalid codes) and ids."""
+        import numpy as np
+        codes = OsmIdCode._as_uint64(nums)
+        types = np.array(['', 'n', 'w', 'r'])[(codes >> np.uint64(62)).astype(np.intp)]
+        ids = codes & np.uint64(OsmIdCode.RESET & (2**64 - 1))
+        return types, ids
+
+    @staticmethod
+    def pack_many(osm_types, osm_ids, int64=False):
+        """Packs arrays of types and ids with NumPy, returns an array of uint64
+        codes (int64 if asked). Invalid types are packed as 0."""
+        import numpy as np
+        typ = np.char.lower(np.asarray(osm_types).astype('U1'))
+        flags = np.zeros(typ.shape, dtype=np.uint64)
+        flags[typ == 'n'] = OsmIdCode.NODE
+        flags[typ == 'w'] = OsmIdCode.WAY
+        flags[typ == 'r'] = OsmIdCode.RELATION
+        result = np.where(flags == 0, np.uint64(0),
+                          np.asarray(osm_ids).astype(np.uint64) | flags)
+        return result.view(np.int64) if int64 else result
+
+
+def map_file(f):
+    """Returns the whole file as a read-only buffer, memory-mapped when possible."""
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError):
+        # Not a regular file (a pipe, BytesIO) or an empty file
+        return f.read()
+
+
+class BufferCursor(object):
+    """File-like reader over a shared buffer, with its own position."""
+
+    def __init__(self, buf, pos=0):
+        self.buf = buf
+        self.pos = pos
+
+    def read(self, size=-1):
+        pos = self.pos
+        if size is None or size < 0:
+            data = self.buf[pos:]
+        else:
+            data = self.buf[pos:pos + size]
+        self.pos = pos + len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += len(self.buf)
+        self.pos = offset
+        return offset
+
+    def tell(self):
+        return self.pos
+
 
 class MWMFile(object):
     # coding/multilang_utf8_string.cpp
@@ -71,21 +151,105 @@ class MWMFile(object):
                  "af", "ja_kana", "lb", "pt", "hr", "fur", "vi", "tr", "bg", "eo", "lt", "la", "kk", "gsw",
                  "et", "ku", "mn", "mk", "lv", "hi"]
 
-    def __init__(self, f):
-        self.f = f
+    # Methods timed when statistics are enabled
+    timed_decoders = ['read_varuint', 'read_string', 'read_numeric_string',
+                      'read_multilang', 'read_coord', 'read_osmid']
+
+    def __init__(self, f, stats=False):
+        self.file = f
+        self.buffer = map_file(f)
+        self._cursor = None
+        self._local = threading.local()
         self.tags = {}
         self.coord_size = None
         self.base_point = (0, 0)
+        self.stats = None
+        if stats:
+            self.enable_stats()
+
+    @property
+    def f(self):
+        """File-like cursor to read from. Each thread gets its own position,
+        so one instance can be queried from many threads at once."""
+        cursor = self._cursor
+        if cursor is None:
+            try:
+                cursor = self._local.cursor
+            except AttributeError:
+                cursor = self._local.cursor = self.new_cursor()
+        return cursor
+
+    def new_cursor(self, offset=0):
+        cursor = BufferCursor(self.buffer, offset)
+        if self.stats is not None:
+            cursor = CountingFile(cursor, self.stats)
+        return cursor
+
+    def cursor(self, offset=0):
+        """Returns a copy of this reader sharing the buffer and tables,
+        but with a separate position, starting at offset."""
+        clone = copy.copy(self)
+        clone._cursor = self.new_cursor(offset)
+        for name in self.timed_decoders:
+            clone.__dict__.pop(name, None)
+        if self.stats is not None:
+            clone._wrap_decoders()
+        return clone
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.file.close()
+
+    def _set_cursor(self, cursor):
+        if self._cursor is not None:
+            self._cursor = cursor
+        else:
+            self._local.cursor = cursor
+
+    def _wrap_decoders(self):
+        for name in self.timed_decoders:
+            setattr(self, name, self.stats.timed(name, getattr(self, name)))
+
+    def enable_stats(self):
+        """Starts counting reads per section and timing decoders, returns a ReadStats.
+        Reads are counted on the calling thread and on threads that start reading later."""
+        if self.stats is None:
+            cursor = self.f
+            self.stats = ReadStats(self.tags)
+            self._set_cursor(CountingFile(cursor, self.stats))
+            self._wrap_decoders()
+        return self.stats
+
+    def disable_stats(self):
+        """Stops collecting statistics and returns what was collected."""
+        stats = self.stats
+        if stats is not None:
+            cursor = self.f
+            if isinstance(cursor, CountingFile):
+                self._set_cursor(cursor.wrapped)
+            for name in self.timed_decoders:
+                del self.__dict__[name]
+            self.stats = None
+        return stats
 
     def read_tags(self):
+        size = len(self.buffer)
         self.f.seek(0)
-        self.f.seek(self.read_uint(8))
+        table = self.read_uint(8)
+        if table >= size:
+            raise Exception('Truncated file: tag table at {0} of {1} bytes'.format(table, size))
+        self.f.seek(table)
         cnt = self.read_varuint()
         for i in range(cnt):
             name = self.read_string(plain=True)
             offset = self.read_varuint()
             length = self.read_varuint()
+            if offset + length > size:
+                raise Exception('Truncated file: section {0} ends after {1} bytes'.format(name, size))
             self.tags[name] = (offset, length)
+        if self.stats is not None:
+            self.stats.set_tags(self.tags)
 
     def has_tag(self, tag):
         return tag in self.tags and self.tags[tag][1] > 0
@@ -101,25 +265,46 @@ class MWMFile(object):
         return pos >= 0 and pos < self.tags[tag][1]
 
     def read_uint(self, bytelen=1):
-        if bytelen == 1:
-            fmt = 'B'
-        elif bytelen == 2:
-            fmt = 'H'
-        elif bytelen == 4:
-            fmt = 'I'
-        elif bytelen == 8:
-            fmt = 'Q'
-        else:
+        fmt = _UINT_STRUCTS.get(bytelen)
+        if fmt is None:
             raise Exception('Bytelen {0} is not supported'.format(bytelen))
-        res = struct.unpack(fmt, self.f.read(bytelen))
+        f = self.f
+        if f.__class__ is BufferCursor:
+            # Fast path: decode straight from the buffer
+            pos = f.pos
+            res = fmt.unpack_from(f.buf, pos)
+            f.pos = pos + bytelen
+            return res[0]
+        res = fmt.unpack(f.read(bytelen))
         return res[0]
 
     def read_varuint(self):
+        f = self.f
+        if f.__class__ is BufferCursor:
+            # Fast path: decode straight from the buffer
+            buf = f.buf
+            pos = f.pos
+            res = 0
+            shift = 0
+            while True:
+                try:
+                    bc = buf[pos]
+                except IndexError:
+                    break
+                if _PY2:
+                    bc = ord(bc)
+                pos += 1
+                res |= (bc & 0x7F) << shift
+                if bc < 0x80:
+                    break
+                shift += 7
+            f.pos = pos
+            return res
         res = 0
         shift = 0
         more = True
         while more:
-            b = self.f.read(1)
+            b = f.read(1)
             if not b:
                 return res
             try:
@@ -228,10 +413,9 @@ class MWMFile(object):
         def find_multilang_next(s, i):
             i += 1
             while i < len(s):
-                try:
-                    c = ord(s[i])
-                except:
-                    c = s[i]
+                c = s[i]
+                if _PY2:
+                    c = ord(c)
                 if c & 0xC0 == 0x80:
                     break
                 if c & 0x80 == 0:
@@ -256,10 +440,10 @@ class MWMFile(object):
         i = 0
         while i < len(s):
             n = find_multilang_next(s, i)
-            try:
-                lng = ord(s[i]) & 0x3F
-            except TypeError:
-                lng = s[i] & 0x3F
+            lng = s[i]
+            if _PY2:
+                lng = ord(lng)
+            lng &= 0x3F
             if lng < len(self.languages):
                 langs[self.languages[lng]] = s[i+1:n].decode('utf-8')
             i = n
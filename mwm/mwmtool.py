@@ -3,8 +3,13 @@ import sys
 import random
 import json
 import argparse
+import os
 import re
-from . import MWM, Osm2Ft, OsmIdCode
+from . import MWM, Osm2Ft, Osm2FtTable, OsmIdCode
+from .diff import diff_mwm, diff_many
+
+# Number of ids translated at once in streaming modes
+BATCH_SIZE = 65536
 
 
 def print_json(data):
@@ -15,10 +20,32 @@ def print_json(data):
         print(s.encode('utf-8'))
 
 
-def dump_mwm(args):
-    mwm = MWM(args.mwm)
+def open_mwm(args, f):
+    mwm = MWM(f, stats=args.stats)
     if args.types:
         mwm.read_types(args.types)
+    args.readers.append(mwm)
+    return mwm
+
+
+def open_osm2ft(args, f, ft2osm=False, tuples=True):
+    osm2ft = Osm2Ft(f, ft2osm, tuples, stats=args.stats)
+    args.readers.append(osm2ft)
+    return osm2ft
+
+
+def open_osm2ft_table(args, f, ft2osm=False):
+    """Reads osm2ft into NumPy arrays when it is installed, into a dict otherwise."""
+    try:
+        osm2ft = Osm2FtTable(f, ft2osm, stats=args.stats)
+    except ImportError:
+        return open_osm2ft(args, f, ft2osm, tuples=False)
+    args.readers.append(osm2ft)
+    return osm2ft
+
+
+def dump_mwm(args):
+    mwm = open_mwm(args, args.mwm)
 
     print('Tags:')
     tvv = sorted([(k, v[0], v[1]) for k, v in mwm.tags.items()], key=lambda x: x[1])
@@ -55,10 +82,7 @@ def dump_mwm(args):
 
 
 def find_feature(args):
-    mwm = MWM(args.mwm)
-    mwm.read_header()
-    if args.types:
-        mwm.read_types(args.types)
+    mwm = open_mwm(args, args.mwm)
     if args.iname:
         args.iname = args.iname.lower()
 
@@ -90,38 +114,195 @@ def find_feature(args):
         print_json(feature)
 
 
+def osm_url(osm_id):
+    type_abbr = {'n': 'node', 'w': 'way', 'r': 'relation'}
+    return 'https://www.openstreetmap.org/{}/{}'.format(type_abbr[osm_id[0]], osm_id[1])
+
+
+def iter_batches(lines, size=BATCH_SIZE):
+    batch = []
+    for line in lines:
+        line = line.strip()
+        if line:
+            batch.append(line)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def write_lines(lines):
+    sys.stdout.write('\n'.join(lines) + '\n')
+
+
+def parse_int(s):
+    try:
+        return int(s)
+    except ValueError:
+        return None
+
+
+def unpack_codes(codes):
+    """Unpacks a list of osm id codes, using NumPy when it is installed."""
+    try:
+        types, ids = OsmIdCode.unpack_many(codes)
+    except ImportError:
+        return [OsmIdCode.unpack(c) for c in codes]
+    return [(t, i) if t else None for t, i in zip(types.tolist(), ids.tolist())]
+
+
+def pack_codes(osm_types, osm_ids, int64=False):
+    """Packs lists of osm types and ids, using NumPy when it is installed."""
+    try:
+        return OsmIdCode.pack_many(osm_types, osm_ids, int64).tolist()
+    except ImportError:
+        return [OsmIdCode.pack(t, i, int64) for t, i in zip(osm_types, osm_ids)]
+
+
+def find_osm_ids(ft2osm, ftids):
+    """Resolves feature ids to osm id tuples, with None for missing ones."""
+    if isinstance(ft2osm, Osm2Ft):
+        codes = ft2osm.get_many(ftids)
+        osm_ids = iter(unpack_codes([c for c in codes if c is not None]))
+        return [None if c is None else next(osm_ids) for c in codes]
+    # Ids that cannot be feature ids are looked up as -1, which is never found
+    codes, found = ft2osm.lookup([-1 if f is None or not 0 <= f < 2**32 else f for f in ftids])
+    types, ids = OsmIdCode.unpack_many(codes)
+    return [(t, i) if ok and t else None
+            for t, i, ok in zip(types.tolist(), ids.tolist(), found.tolist())]
+
+
 def ft2osm(args):
-    ft2osm = Osm2Ft(args.osm2ft, True)
+    if args.file:
+        batches = iter_batches(args.file)
+    elif args.ftid:
+        batches = [args.ftid]
+    else:
+        print('Please specify feature ids or a file with them')
+        return 2
+    ft2osm = open_osm2ft_table(args, args.osm2ft, True)
     code = 0
-    type_abbr = {'n': 'node', 'w': 'way', 'r': 'relation'}
-    for ftid in args.ftid:
-        if ftid in ft2osm:
-            print('https://www.openstreetmap.org/{}/{}'.format(
-                type_abbr[ft2osm[ftid][0]],
-                ft2osm[ftid][1]))
-        else:
-            print('Could not find osm id for feature {}'.format(ftid))
-            code = 2
+    for batch in batches:
+        ftids = [parse_int(ftid) for ftid in batch]
+        lines = []
+        for line, ftid, osm_id in zip(batch, ftids, find_osm_ids(ft2osm, ftids)):
+            if ftid is None:
+                lines.append('Not a feature id: {}'.format(line))
+                code = 2
+            elif osm_id is not None:
+                lines.append(osm_url(osm_id))
+            else:
+                lines.append('Could not find osm id for feature {}'.format(ftid))
+                code = 2
+        write_lines(lines)
     return code
 
 
-def decode_id(args):
-    if args.id.isdigit() or args.id.startswith('-'):
-        osm_id = OsmIdCode.unpack(int(args.id))
+def convert_ids(batch, int64=False):
+    """Decodes numbers and encodes links in a batch, returns output lines and an error flag."""
+    result = [None] * len(batch)
+    failed = False
+    numeric = []
+    for i, s in enumerate(batch):
+        if s.isdigit() or s.startswith('-'):
+            if parse_int(s) is None:
+                result[i] = 'That is not a valid identifier'
+                failed = True
+            else:
+                numeric.append(i)
+    for i, osm_id in zip(numeric, unpack_codes([int(batch[i]) for i in numeric])):
         if osm_id is None:
-            print('That is not a valid identifier')
-            return 2
+            result[i] = 'That is not a valid identifier'
+            failed = True
         else:
-            type_abbr = {'n': 'node', 'w': 'way', 'r': 'relation'}
-            print('https://www.openstreetmap.org/{}/{}'.format(
-                type_abbr[osm_id[0]], osm_id[1]))
+            result[i] = osm_url(osm_id)
+    links = []
+    for i, s in enumerate(batch):
+        if result[i] is None:
+            m = re.search(r'(node|way|relation)/(\d+)', s)
+            if m:
+                links.append((i, m.group(1), int(m.group(2))))
+            else:
+                result[i] = 'Please specify an URL to OSM object on its website'
+                failed = True
+    packed = pack_codes([link[1] for link in links], [link[2] for link in links], int64)
+    for link, code in zip(links, packed):
+        result[link[0]] = str(code)
+    return result, failed
+
+
+def decode_id(args):
+    if args.file:
+        batches = iter_batches(args.file)
+    elif args.id:
+        batches = [[args.id]]
+    else:
+        print('Please specify an id or a file with them')
+        return 2
+    code = 0
+    for batch in batches:
+        lines, failed = convert_ids(batch, args.int64)
+        write_lines(lines)
+        if failed:
+            code = 2
+    return code
+
+
+def diff_files(args):
+    try:
+        for record in diff_mwm(args.old, args.new, args.old_osm2ft, args.new_osm2ft, args.types):
+            yield args.old, args.new, record
+    except EnvironmentError as e:
+        yield args.old, args.new, {'change': 'error', 'error': str(e)}
+
+
+def diff_mwms(args):
+    try:
+        import numpy
+    except ImportError:
+        print('Comparing releases requires NumPy, install it with "pip install mwm[numpy]"')
+        return 2
+    regions = []  # (name, 'region_added' or 'region_removed')
+    if os.path.isdir(args.old) and os.path.isdir(args.new):
+        old_names = set(n[:-4] for n in os.listdir(args.old) if n.endswith('.mwm'))
+        new_names = set(n[:-4] for n in os.listdir(args.new) if n.endswith('.mwm'))
+        regions = sorted([(n, 'region_removed') for n in old_names - new_names] +
+                         [(n, 'region_added') for n in new_names - old_names])
+        pairs = [(os.path.join(args.old, n + '.mwm'), os.path.join(args.new, n + '.mwm'))
+                 for n in sorted(old_names & new_names)]
+        records = diff_many(pairs, args.jobs, args.types)
+    elif os.path.isfile(args.old) and os.path.isfile(args.new):
+        records = diff_files(args)
     else:
-        m = re.search(r'(node|way|relation)/(\d+)', args.id)
-        if m:
-            print(OsmIdCode.pack(m.group(1), int(m.group(2)), args.int64))
+        print('Please specify either two mwm files or two directories')
+        return 2
+
+    # A region present in only one release cannot be compared
+    code = 2 if regions else 0
+    for region, change in regions:
+        if args.summary:
+            print('{0}: {1}'.format(region, change.replace('_', ' ')))
         else:
-            print('Please specify an URL to OSM object on its website')
-            return 2
+            print_json({'change': change, 'region': region})
+
+    counts = {}
+    for old_path, new_path, record in records:
+        region = os.path.basename(new_path)[:-4]
+        if record['change'] == 'error':
+            print('{0}: {1}'.format(region, record['error']), file=sys.stderr)
+            code = 2
+            continue
+        counts.setdefault(region, {'added': 0, 'removed': 0, 'changed': 0})
+        counts[region][record['change']] += 1
+        if not args.summary:
+            record['region'] = region
+            print_json(record)
+    if args.summary:
+        for region, c in sorted(counts.items()):
+            print('{0}: {1} added, {2} removed, {3} changed'.format(
+                region, c['added'], c['removed'], c['changed']))
+    return code
 
 
 def dat_to_gpx(args):
@@ -135,6 +316,10 @@ def dat_to_gpx(args):
 def main():
     parser = argparse.ArgumentParser(description='Toolbox for MWM files.')
     parser.add_argument('-t', '--types', help='path to types.txt')
+    parser.add_argument('--stats', action='store_true',
+                        help='print read statistics per section and decoder to stderr')
+    parser.add_argument('--profile', action='store_true',
+                        help='run the command under cProfile and print hot spots to stderr')
     subparsers = parser.add_subparsers(dest='cmd')
     subparsers.required = True
 
@@ -142,7 +327,7 @@ def main():
     parser_dump.add_argument('mwm', type=argparse.FileType('rb'), help='file to browse')
     parser_dump.add_argument('-s', '--short', action='store_true',
                              help='Read header only, no features')
-    parser_dump.set_defaults(func=dump_mwm)
+    parser_dump.set_defaults(func=dump_mwm, with_stats=True)
 
     parser_find = subparsers.add_parser('find', help='Finds features in a file.')
     parser_find.add_argument('mwm', type=argparse.FileType('rb'), help='file to search')
@@ -160,27 +345,57 @@ def main():
                              help='look for a metadata key ("m flats" for features with flats)')
     parser_find.add_argument('-id', dest='fid', type=int,
                              help='look for a feature id ("-id 1234 for feature #1234)')
-    parser_find.set_defaults(func=find_feature)
+    parser_find.set_defaults(func=find_feature, with_stats=True)
 
     parser_osm = subparsers.add_parser('osm',
                                        help='Displays an OpenStreetMap link for a feature id.')
     parser_osm.add_argument('osm2ft', type=argparse.FileType('rb'), help='.mwm.osm2ft file')
-    parser_osm.add_argument('ftid', type=int, nargs='+', help='feature id')
-    parser_osm.set_defaults(func=ft2osm)
+    parser_osm.add_argument('ftid', type=int, nargs='*', help='feature id')
+    parser_osm.add_argument('-f', '--file', type=argparse.FileType('r'),
+                            help='read feature ids from a file, one per line ("-" for stdin)')
+    parser_osm.set_defaults(func=ft2osm, with_stats=True)
 
     parser_id = subparsers.add_parser('id', help='Decode or encode OSM ID')
-    parser_id.add_argument('id', help='MWM internal OSM ID, or a link to OSM website')
+    parser_id.add_argument('id', nargs='?',
+                           help='MWM internal OSM ID, or a link to OSM website')
+    parser_id.add_argument('-f', '--file', type=argparse.FileType('r'),
+                           help='read ids or links from a file, one per line ("-" for stdin)')
     parser_id.add_argument('-i', '--int64', action='store_true',
                            help='Use int64 instead of uint64')
     parser_id.set_defaults(func=decode_id)
 
+    parser_diff = subparsers.add_parser('diff', help='Compares features of two releases')
+    parser_diff.add_argument('old', help='old mwm file, or a directory with mwm files')
+    parser_diff.add_argument('new', help='new mwm file, or a directory with mwm files')
+    parser_diff.add_argument('--old-osm2ft', help='old .mwm.osm2ft file, if not next to mwm')
+    parser_diff.add_argument('--new-osm2ft', help='new .mwm.osm2ft file, if not next to mwm')
+    parser_diff.add_argument('-j', '--jobs', type=int,
+                             help='number of processes for directories (default is cpu count)')
+    parser_diff.add_argument('-s', '--summary', action='store_true',
+                             help='print only counts of changes per region')
+    parser_diff.set_defaults(func=diff_mwms)
+
     parser_dump = subparsers.add_parser('gpx', help='Convert gps_track.dat to GPX')
     parser_dump.add_argument('dat', type=argparse.FileType('rb'), help='file to convert')
     parser_dump.add_argument('--gpx', '-o', type=argparse.FileType('w'), help='output gpx file')
     parser_dump.set_defaults(func=dat_to_gpx)
 
     args = parser.parse_args()
-    code = args.func(args)
+    if args.stats and not getattr(args, 'with_stats', False):
+        parser.error('--stats is not supported for the {0} command'.format(args.cmd))
+    args.readers = []
+    if args.profile:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        code = profiler.runcall(args.func, args)
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(25)
+    else:
+        code = args.func(args)
+    if args.stats:
+        for reader in args.readers:
+            print('Statistics for {0}:'.format(reader.file.name), file=sys.stderr)
+            print(reader.stats.format(), file=sys.stderr)
     if code is not None:
         sys.exit(code)
 
@@ -3,8 +3,8 @@ from .mwmfile import MWMFile
 
 
 class Osm2Ft(MWMFile):
-    def __init__(self, f, ft2osm=False, tuples=True):
-        MWMFile.__init__(self, f)
+    def __init__(self, f, ft2osm=False, tuples=True, stats=False):
+        MWMFile.__init__(self, f, stats)
         self.read(ft2osm, tuples)
 
     def read(self, ft2osm=False, tuples=True):
@@ -22,6 +22,11 @@ class Osm2Ft(MWMFile):
                 else:
                     self.data[osmid] = fid
 
+    def get_many(self, keys):
+        """Looks up a batch of keys, returns a list with None for missing ones."""
+        get = self.data.get
+        return [get(k) for k in keys]
+
     def __getitem__(self, k):
         return self.data.get(k)
 
@@ -36,3 +41,56 @@ class Osm2Ft(MWMFile):
 
     def __iter__(self):
         return iter(self.data)
+
+
+class Osm2FtTable(MWMFile):
+    """Reads mwm.osm2ft into NumPy arrays sorted by key, for looking up
+    batches of ids without a dict. Keys are feature ids with ft2osm,
+    otherwise uint64 osm id codes; values are the other ones."""
+    RECORD = [('osmid', '<u8'), ('fid', '<u4'), ('filler', '<u4')]
+
+    def __init__(self, f, ft2osm=False, stats=False):
+        import numpy as np
+        MWMFile.__init__(self, f, stats)
+        self.ft2osm = ft2osm
+        count = self.read_varuint()
+        records = np.frombuffer(self.buffer, dtype=self.RECORD, count=count, offset=self.f.tell())
+        if ft2osm:
+            keys, values = records['fid'].astype(np.int64), records['osmid'].copy()
+        else:
+            keys, values = records['osmid'].copy(), records['fid'].copy()
+        # Drop the view, so that the mapped file can be closed
+        del records
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.values = values[order]
+
+    def lookup(self, keys):
+        """Looks up an array of keys, returns an array of values and a boolean
+        array of found keys. As with a dict, the last of duplicate keys wins."""
+        import numpy as np
+        keys = np.asarray(keys, dtype=self.keys.dtype)
+        if not len(self.keys):
+            return np.zeros(keys.shape, dtype=self.values.dtype), np.zeros(keys.shape, dtype=bool)
+        # Sorted needles walk the table in order, which is a lot faster
+        order = np.argsort(keys, kind='stable')
+        pos = np.empty(keys.shape, dtype=np.intp)
+        pos[order] = np.searchsorted(self.keys, keys[order], side='right') - 1
+        found = pos >= 0
+        pos[~found] = 0
+        found &= self.keys[pos] == keys
+        return self.values[pos], found
+
+    def get_many(self, keys):
+        """Looks up a batch of keys, returns a list with None for missing ones."""
+        values, found = self.lookup(keys)
+        return [v if ok else None for v, ok in zip(values.tolist(), found.tolist())]
+
+    def __getitem__(self, k):
+        return self.get_many([k])[0]
+
+    def __repr__(self):
+        return '{} table with {} items'.format('ft2osm' if self.ft2osm else 'osm2ft', len(self.keys))
+
+    def __len__(self):
+        return len(self.keys)
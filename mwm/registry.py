@@ -0,0 +1,165 @@
+# Registry of MWM Files
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from .mwm import MWM
+from .cache import LRUCache
+
+
+def bbox_intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+class _PoolEntry(object):
+    def __init__(self, mwm):
+        self.mwm = mwm
+        self.users = 0
+        self.evicted = False
+
+
+class MWMRegistry(object):
+    """Indexes a directory of mwm files by region name and bounds, and keeps
+    a bounded pool of open readers, closing least recently used ones.
+
+    Readers are borrowed with reader(). A reader evicted from the pool while
+    borrowed is closed when the last borrower releases it. Readers share
+    one LRUCache of cache_size bytes."""
+
+    def __init__(self, path, max_open=16, cache_size=0, types=None):
+        self.path = path
+        self.max_open = max_open
+        self.cache = LRUCache(cache_size) if cache_size else None
+        self.types = types
+        self.regions = {}  # name -> {'path', 'bounds', 'mapType'}
+        self.errors = {}  # name -> error message for files that could not be read
+        self._pool = OrderedDict()  # name -> _PoolEntry
+        self._lock = threading.Lock()
+        self.scan()
+
+    def scan(self):
+        """Reads headers of all mwm files in the directory. Files that cannot
+        be read are skipped and listed in errors."""
+        regions = {}
+        errors = {}
+        for filename in sorted(os.listdir(self.path)):
+            if not filename.endswith('.mwm'):
+                continue
+            name = filename[:-4]
+            try:
+                mwm = self._open(os.path.join(self.path, filename))
+            except Exception as e:
+                errors[name] = str(e) or e.__class__.__name__
+                continue
+            regions[name] = {
+                'path': os.path.join(self.path, filename),
+                'bounds': mwm.header.get('bounds'),
+                'mapType': mwm.header.get('mapType'),
+            }
+            with self._lock:
+                self._add(name, _PoolEntry(mwm))
+        self.regions = regions
+        self.errors = errors
+
+    def _open(self, path):
+        f = open(path, 'rb')
+        try:
+            mwm = MWM(f)
+            if self.types:
+                mwm.read_types(self.types)
+            if self.cache is not None:
+                mwm.set_cache(self.cache)
+        except Exception:
+            f.close()
+            raise
+        return mwm
+
+    def _add(self, name, entry):
+        """Puts an entry to the pool and evicts old ones. Call under the lock."""
+        old = self._pool.pop(name, None)
+        if old is not None:
+            self._evict(old)
+        self._pool[name] = entry
+        while len(self._pool) > self.max_open:
+            self._evict(self._pool.popitem(last=False)[1])
+
+    def _evict(self, entry):
+        entry.evicted = True
+        if entry.users == 0:
+            entry.mwm.close()
+
+    def _acquire(self, name):
+        with self._lock:
+            entry = self._pool.pop(name, None)
+            if entry is not None:
+                self._pool[name] = entry
+                entry.users += 1
+                return entry
+        entry = _PoolEntry(self._open(self.regions[name]['path']))
+        entry.users += 1
+        with self._lock:
+            self._add(name, entry)
+        return entry
+
+    def _release(self, entry):
+        with self._lock:
+            entry.users -= 1
+            if entry.evicted and entry.users == 0:
+                entry.mwm.close()
+
+    @contextmanager
+    def reader(self, name):
+        """Borrows an open reader for a region, raises KeyError for an unknown one.
+        The reader can be shared between threads, but must not be used after
+        the with block ends."""
+        entry = self._acquire(name)
+        try:
+            yield entry.mwm
+        finally:
+            self._release(entry)
+
+    def find_regions(self, lon, lat, include_world=False):
+        """Returns names of regions whose bounds contain the point."""
+        return self.regions_in_bbox((lon, lat, lon, lat), include_world)
+
+    def regions_in_bbox(self, bbox, include_world=False):
+        """Returns names of regions whose bounds intersect (min_lon, min_lat, max_lon, max_lat)."""
+        result = []
+        for name, region in sorted(self.regions.items()):
+            if region['bounds'] is None:
+                continue
+            if not include_world and region['mapType'] != 'country':
+                continue
+            if bbox_intersects(region['bounds'], bbox):
+                result.append(name)
+        return result
+
+    def get_feature(self, name, fid, metadata=False):
+        with self.reader(name) as mwm:
+            return mwm.get_feature(fid, metadata)
+
+    def iter_features(self, bbox, metadata=False, include_world=False):
+        """Yields (region name, feature) for point features inside the bbox."""
+        for name in self.regions_in_bbox(bbox, include_world):
+            with self.reader(name) as mwm:
+                for feature in mwm.cursor().iter_features(metadata, bbox):
+                    yield name, feature
+
+    def close(self):
+        """Closes all pooled readers, borrowed ones when they are released."""
+        with self._lock:
+            pool, self._pool = self._pool, OrderedDict()
+            for entry in pool.values():
+                self._evict(entry)
+
+    def __repr__(self):
+        return 'MWMRegistry of {} regions, {} open'.format(len(self.regions), len(self._pool))
+
+    def __len__(self):
+        return len(self.regions)
+
+    def __contains__(self, name):
+        return name in self.regions
+
+    def __iter__(self):
+        return iter(self.regions)
@@ -0,0 +1,139 @@
+# Read Statistics
+import inspect
+import threading
+import time
+from bisect import bisect_right
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class ReadStats(object):
+    """Collects bytes read and calls per section, seeks and time spent in decoders.
+
+    Decoder times are inclusive: read_multilang() also counts in read_string()
+    and read_varuint() it calls. Counters are updated under a lock, so one
+    instance can collect reads from many threads."""
+    UNTAGGED = '(untagged)'
+
+    def __init__(self, tags=None):
+        self.sections = {}  # name -> [bytes, reads]
+        self.decoders = {}  # name -> [calls, seconds]
+        self.seeks = 0
+        self._lock = threading.Lock()
+        self.set_tags(tags or {})
+
+    def set_tags(self, tags):
+        spans = sorted((v[0], v[0] + v[1], k) for k, v in tags.items() if v[1] > 0)
+        self._spans = ([s[0] for s in spans], spans)
+
+    def section_at(self, pos):
+        starts, spans = self._spans
+        i = bisect_right(starts, pos) - 1
+        if i >= 0 and pos < spans[i][1]:
+            return spans[i][2]
+        return self.UNTAGGED
+
+    def add_read(self, pos, length):
+        name = self.section_at(pos)
+        with self._lock:
+            entry = self.sections.get(name)
+            if entry is None:
+                entry = self.sections[name] = [0, 0]
+            entry[0] += length
+            entry[1] += 1
+
+    def add_seek(self):
+        with self._lock:
+            self.seeks += 1
+
+    def _decoder(self, name):
+        with self._lock:
+            entry = self.decoders.get(name)
+            if entry is None:
+                entry = self.decoders[name] = [0, 0.0]
+            return entry
+
+    def _add_time(self, entry, calls, seconds):
+        with self._lock:
+            entry[0] += calls
+            entry[1] += seconds
+
+    def timed(self, name, method):
+        """Wraps a bound method, so that its calls and run time are counted."""
+        entry = self._decoder(name)
+        if inspect.isgeneratorfunction(method):
+            def timed_generator(*args, **kwargs):
+                self._add_time(entry, 1, 0.0)
+                gen = method(*args, **kwargs)
+                while True:
+                    start = _clock()
+                    try:
+                        item = next(gen)
+                    except StopIteration:
+                        self._add_time(entry, 0, _clock() - start)
+                        return
+                    self._add_time(entry, 0, _clock() - start)
+                    yield item
+            return timed_generator
+
+        def timed_method(*args, **kwargs):
+            start = _clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._add_time(entry, 1, _clock() - start)
+        return timed_method
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(v[0] for v in self.sections.values())
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'sections': {k: {'bytes': v[0], 'reads': v[1]}
+                             for k, v in self.sections.items()},
+                'decoders': {k: {'calls': v[0], 'seconds': v[1]}
+                             for k, v in self.decoders.items() if v[0]},
+                'seeks': self.seeks,
+            }
+
+    def format(self):
+        with self._lock:
+            sections = [(k, list(v)) for k, v in self.sections.items()]
+            decoders = [(k, list(v)) for k, v in self.decoders.items()]
+            seeks = self.seeks
+        lines = ['Sections:']
+        for name, v in sorted(sections, key=lambda x: -x[1][0]):
+            lines.append('  {0:<12}: {1:10} bytes in {2:9} reads'.format(name, v[0], v[1]))
+        lines.append('Seeks: {0}'.format(seeks))
+        lines.append('Decoders:')
+        for name, v in sorted(decoders, key=lambda x: -x[1][1]):
+            if v[0]:
+                lines.append('  {0:<20}: {1:9} calls {2:10.4f} s {3:8.2f} us/call'.format(
+                    name, v[0], v[1], v[1] * 1e6 / v[0]))
+        return '\n'.join(lines)
+
+
+class CountingFile(object):
+    """File object wrapper that reports reads and seeks to a ReadStats."""
+
+    def __init__(self, f, stats):
+        self.wrapped = f
+        self.stats = stats
+
+    def read(self, size=-1):
+        pos = self.wrapped.tell()
+        data = self.wrapped.read(size)
+        self.stats.add_read(pos, len(data))
+        return data
+
+    def seek(self, offset, whence=0):
+        self.stats.add_seek()
+        return self.wrapped.seek(offset, whence)
+
+    def tell(self):
+        return self.wrapped.tell()
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
@@ -11,6 +11,7 @@ setup(
     author_email='ilya@zverev.info',
     packages=['mwm'],
     package_data={'mwm': ['types.txt']},
+    extras_require={'numpy': ['numpy']},
     url='https://github.com/mapsme/mwm.py',
     license='Apache License 2.0',
     description='Library to read binary MAPS.ME files.',